@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 """MidCity Utilities sensor for Home Assistant."""
+import time
+IMPORT_STARTED = time.perf_counter()
+
+import argparse
+import functools
 import requests
 import sys
 import os
 import json
-import time
 import logging
-from bs4 import BeautifulSoup
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 import paho.mqtt.client as mqtt
 
+# BeautifulSoup (parse_meter_page()), NumPy (BalanceForecaster) and the profilers (run_profiled())
+# are imported on first use to keep startup fast
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 # Set up logging
 log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
@@ -29,19 +41,596 @@ MQTT_PASSWORD = None
 LOGIN_URL = "https://buyprepaid.midcityutilities.co.za/ajax/login"
 METER_URL = "https://buyprepaid.midcityutilities.co.za/meters"
 
+# Device shared by all entities published by this add-on
+SW_VERSION = "1.8.0"
+DEVICE_INFO = {
+    "identifiers": ["midcity_utilities_sensor"],
+    "name": "MidCity Utilities Sensor",
+    "model": "MidCity Utilities Monitor",
+    "manufacturer": "MidCity Utilities",
+    "sw_version": SW_VERSION
+}
+
+# Warm restart snapshot, written after every successful cycle
+SNAPSHOT_PATH = "/data/snapshot.json"
+SNAPSHOT_FORMAT = 2  # Bumped when the published topics change, older messages are not replayed
+
+# Where --profile writes its stats
+PROFILE_DIR = "/data"
+
+# Portal requests: the timeout bounds each socket read, the deadline the whole request
+REQUEST_TIMEOUT = 30
+REQUEST_DEADLINE = 90
+
+# Seconds to wait for the MQTT broker before publishing a cycle
+MQTT_CONNECT_TIMEOUT = 30
+
+# Watchdog and health endpoint
+HEALTH_PORT = 8099
+WATCHDOG_INTERVAL = 30          # Seconds between health checks
+WATCHDOG_CYCLE_BUDGET = 600     # Longest a single update cycle may run before the loop counts as stuck
+
+# Balance forecasting
+FORECAST_WINDOW_HOURS = 7 * 24   # Age after which a reading leaves the window
+FORECAST_HALF_LIFE_HOURS = 48.0  # Age at which a reading counts half as much as a new one
+FORECAST_MIN_READINGS = 6        # Readings needed before a forecast is published
+FORECAST_MIN_SPAN_HOURS = 1.0    # Time the readings must cover before a forecast is published
+FORECAST_CONFIDENCE_Z = 1.96     # ~95% prediction band
+FORECAST_BAND_MIN_DAYS = 2       # Whole days of readings needed before the band is published
+
+
+class BalanceForecaster:
+    """Rolling burn-rate forecaster for a single meter.
+
+    Each reading is turned into cumulative consumption (top-ups are ignored)
+    and fitted against time with an exponentially weighted least-squares
+    regression. Daily sine/cosine terms absorb time-of-day usage patterns so
+    the linear term is the average burn rate. Only the weighted normal
+    equations are kept, so adding a reading costs the same no matter how
+    many are in the window.
+
+    Consecutive readings of cumulative consumption are strongly correlated,
+    so the regression residuals say little about how uncertain the forecast
+    is. The depletion band instead comes from how much consumption varies
+    from one day to the next, scaled to the forecast horizon. Days are 24
+    hour blocks from the first reading, and running sums of the whole days
+    in the window are kept so the band is also constant time.
+    """
+
+    def __init__(self, window_hours=FORECAST_WINDOW_HOURS, half_life_hours=FORECAST_HALF_LIFE_HOURS):
+        """Initialize the forecaster."""
+        import numpy as np
+        self.readings = deque()
+        self.window_hours = window_hours
+        self.decay_per_hour = math.log(2) / half_life_hours
+        self.origin = None
+        self.last_time = None
+        self.last_balance = None
+        self.consumed = 0.0
+
+        # Weighted sufficient statistics: X'WX, X'Wy, sum(w)
+        self.xtwx = np.zeros((4, 4))
+        self.xtwy = np.zeros(4)
+        self.weight_sum = 0.0
+
+        # Consumption so far today, whole days as (day, consumed), and their sum and sum of squares
+        self.day_consumed = 0.0
+        self.days = deque()
+        self.day_sum = 0.0
+        self.day_sq_sum = 0.0
+
+    @staticmethod
+    def _features(hours, timestamp):
+        """Build the regression row [1, t, sin(day), cos(day)] for a reading."""
+        import numpy as np
+        local = datetime.fromtimestamp(timestamp)
+        angle = 2 * math.pi * (local.hour + local.minute / 60) / 24
+        return np.array([1.0, hours, math.sin(angle), math.cos(angle)])
+
+    def add_reading(self, balance, timestamp=None):
+        """Add a balance reading taken at ``timestamp`` (epoch seconds)."""
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.origin is None:
+            self.origin = timestamp
+            self.last_time = timestamp
+            self.last_balance = balance
+        if timestamp < self.last_time:
+            logger.debug("Ignoring out-of-order reading for forecast")
+            return
+
+        # A drop in balance is consumption; a rise is a top-up and is skipped
+        used = max(self.last_balance - balance, 0.0)
+        self.consumed += used
+        self.last_balance = balance
+        last_hours = (self.last_time - self.origin) / 3600
+
+        # Age every existing reading by the time elapsed since the last one
+        elapsed = (timestamp - self.last_time) / 3600
+        decay = math.exp(-self.decay_per_hour * elapsed)
+        self.xtwx *= decay
+        self.xtwy *= decay
+        self.weight_sum *= decay
+        self.last_time = timestamp
+
+        hours = (timestamp - self.origin) / 3600
+        x = self._features(hours, timestamp)
+        self._accumulate(x, self.consumed, 1.0)
+        self.readings.append((hours, x, self.consumed))
+        self._add_daily(last_hours, hours, used)
+
+        # Drop readings that have aged out of the window, whatever the scan interval
+        while self.readings[0][0] < hours - self.window_hours:
+            old_hours, old_x, old_y = self.readings.popleft()
+            old_weight = math.exp(-self.decay_per_hour * (hours - old_hours))
+            self._accumulate(old_x, old_y, -old_weight)
+        while self.days and self.days[0][0] * 24 < hours - self.window_hours:
+            _, old_consumed = self.days.popleft()
+            self.day_sum -= old_consumed
+            self.day_sq_sum -= old_consumed * old_consumed
+
+    def _add_daily(self, start_hours, end_hours, used):
+        """Spread the consumption between two readings over the days it covers."""
+        day = int(start_hours // 24)
+        while end_hours >= (day + 1) * 24:
+            boundary = (day + 1) * 24
+            share = used * (boundary - start_hours) / (end_hours - start_hours)
+            self.day_consumed += share
+            used -= share
+            start_hours = boundary
+
+            # The day is over, add it to the whole-day totals
+            self.days.append((day, self.day_consumed))
+            self.day_sum += self.day_consumed
+            self.day_sq_sum += self.day_consumed * self.day_consumed
+            self.day_consumed = 0.0
+            day += 1
+        self.day_consumed += used
+
+    def _accumulate(self, x, y, weight):
+        """Add (or with a negative weight, remove) one reading from the statistics."""
+        import numpy as np
+        self.xtwx += weight * np.outer(x, x)
+        self.xtwy += weight * y * x
+        self.weight_sum += weight
+
+    def to_dict(self):
+        """Serialise the forecaster state for the warm-restart snapshot."""
+        return {
+            'origin': self.origin,
+            'last_time': self.last_time,
+            'last_balance': self.last_balance,
+            'consumed': self.consumed,
+            'xtwx': self.xtwx.tolist(),
+            'xtwy': self.xtwy.tolist(),
+            'weight_sum': self.weight_sum,
+            'day_consumed': self.day_consumed,
+            'days': [list(day) for day in self.days],
+            'day_sum': self.day_sum,
+            'day_sq_sum': self.day_sq_sum,
+            'readings': [[hours, consumed] for hours, _, consumed in self.readings]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore a forecaster saved with to_dict()."""
+        import numpy as np
+        forecaster = cls()
+        forecaster.origin = data['origin']
+        forecaster.last_time = data['last_time']
+        forecaster.last_balance = data['last_balance']
+        forecaster.consumed = data['consumed']
+        forecaster.xtwx = np.array(data['xtwx'])
+        forecaster.xtwy = np.array(data['xtwy'])
+        forecaster.weight_sum = data['weight_sum']
+        forecaster.day_consumed = data.get('day_consumed', 0.0)
+        forecaster.days = deque(tuple(day) for day in data.get('days', []))
+        forecaster.day_sum = data.get('day_sum', 0.0)
+        forecaster.day_sq_sum = data.get('day_sq_sum', 0.0)
+        # Readings past the window are evicted by the next add_reading(), keeping the statistics in step
+        for hours, consumed in data['readings']:
+            x = cls._features(hours, forecaster.origin + hours * 3600)
+            forecaster.readings.append((hours, x, consumed))
+        return forecaster
+
+    def _prediction_band(self, rate, balance):
+        """Return (rate_error, hours_low, hours_high) for the depletion time.
+
+        Consumption over a horizon of H hours is modelled as rate * H with
+        variance a * H + b * H^2, where a is the day-to-day variance spread
+        per hour and b the squared standard error of the burn rate. The band
+        edges are the horizons at which that consumption reaches the balance
+        at the upper and lower end of the interval.
+        """
+        days = len(self.days)
+        if days < FORECAST_BAND_MIN_DAYS or rate <= 0:
+            return None, None, None
+        mean = self.day_sum / days
+        daily_variance = max(self.day_sq_sum - days * mean * mean, 0.0) / (days - 1)
+        rate_error = math.sqrt(daily_variance / days) / 24
+        if balance <= 0:
+            return rate_error, 0.0, 0.0
+
+        z2 = FORECAST_CONFIDENCE_Z ** 2
+        a = daily_variance / 24
+        b = rate_error ** 2
+        # (rate * H - balance)^2 = z^2 * (a * H + b * H^2), solved for H
+        quadratic = rate ** 2 - z2 * b
+        linear = 2 * rate * balance + z2 * a
+        # Never negative in exact arithmetic, but rounds below zero when daily usage does not vary
+        root = math.sqrt(max(linear ** 2 - 4 * quadratic * balance ** 2, 0.0))
+        hours_low = 2 * balance ** 2 / (linear + root)
+        # With an uncertain enough burn rate the balance may never run out
+        hours_high = (linear + root) / (2 * quadratic) if quadratic > 0 else None
+        return rate_error, hours_low, hours_high
+
+    def forecast(self):
+        """Return the current forecast as a dict, or None if there is not enough data."""
+        import numpy as np
+        if len(self.readings) < FORECAST_MIN_READINGS:
+            logger.debug(f"Forecast needs {FORECAST_MIN_READINGS} readings, have {len(self.readings)}")
+            return None
+        span = self.readings[-1][0] - self.readings[0][0]
+        if span < FORECAST_MIN_SPAN_HOURS:
+            logger.debug(f"Forecast needs {FORECAST_MIN_SPAN_HOURS}h of readings, have {span:.2f}h")
+            return None
+
+        # Measure time from the latest reading so the intercept and slope are not collinear
+        shift = np.eye(4)
+        shift[1, 0] = -(self.last_time - self.origin) / 3600
+        xtwx = shift @ self.xtwx @ shift.T
+        xtwy = shift @ self.xtwy
+
+        # Shrink the daily terms towards zero while the window is too short to tell them from the trend
+        ridge = np.diag([0.0, 0.0, 0.01, 0.01]) * self.weight_sum
+        try:
+            inverse = np.linalg.inv(xtwx + ridge)
+        except np.linalg.LinAlgError:
+            logger.debug("Forecast regression is singular")
+            return None
+        beta = inverse @ xtwy
+
+        rate = float(beta[1])
+        balance = max(self.last_balance, 0.0)
+        hours_remaining = balance / rate if rate > 0 else None
+        rate_error, hours_low, hours_high = self._prediction_band(rate, balance)
+
+        def depletion_time(hours):
+            if hours is None:
+                return None
+            return datetime.fromtimestamp(self.last_time + hours * 3600).astimezone().isoformat()
+
+        return {
+            'burn_rate': round(rate, 4),
+            'burn_rate_error': round(rate_error, 4) if rate_error is not None else None,
+            'hours_remaining': round(hours_remaining, 1) if hours_remaining is not None else None,
+            'hours_remaining_low': round(hours_low, 1) if hours_low is not None else None,
+            'hours_remaining_high': round(hours_high, 1) if hours_high is not None else None,
+            'predicted_depletion': depletion_time(hours_remaining),
+            'depletion_earliest': depletion_time(hours_low),
+            'depletion_latest': depletion_time(hours_high),
+            'readings': len(self.readings),
+            'window_hours': round(span, 1)
+        }
+
+
+class PhaseProfile:
+    """Records when each phase of a cycle ran and how long it took.
+
+    Phases may overlap since the Supervisor lookup, broker connect and first
+    portal login run concurrently. Recording stops at finish(), which the
+    sensor calls once the first cycle has been published.
+    """
+
+    def __init__(self):
+        """Initialize the profile."""
+        self.started = time.perf_counter()
+        self.running = {}
+        self.phases = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self, name):
+        """Mark the start of a phase."""
+        with self.lock:
+            if not self.finished:
+                self.running[name] = time.perf_counter()
+
+    def stop(self, name):
+        """Mark the end of a phase started with start()."""
+        with self.lock:
+            started = self.running.pop(name, None)
+            if started is not None and not self.finished:
+                self.phases.append((name, started - self.started, time.perf_counter() - started))
+
+    @contextmanager
+    def phase(self, name):
+        """Record the wrapped block as a phase."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def durations(self):
+        """Return the total time spent in each phase, in seconds."""
+        totals = {}
+        for name, _, duration in self.phases:
+            totals[name] = totals.get(name, 0.0) + duration
+        return totals
+
+    def finish(self):
+        """Stop recording and return the startup breakdown as printable text."""
+        with self.lock:
+            self.finished = True
+            total = time.perf_counter() - self.started
+
+        lines = [
+            "Startup profile",
+            f"  {'phase':<24}{'start':>10}{'duration':>10}",
+            f"  {'module imports':<24}{'-':>10}{IMPORT_SECONDS * 1000:>8.0f}ms"
+        ]
+        for name, offset, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"  {name:<24}{offset * 1000:>8.0f}ms{duration * 1000:>8.0f}ms")
+        lines.append(f"  {'first publish':<24}{'-':>10}{total * 1000:>8.0f}ms")
+        return "\n".join(lines)
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """HTTP handler serving the watchdog status on /health."""
+
+    watchdog = None
+
+    def do_GET(self):
+        """Return 200 when healthy and 503 otherwise."""
+        if self.path.rstrip('/') not in ('', '/health'):
+            self.send_error(404)
+            return
+
+        status = self.watchdog.status()
+        body = json.dumps(status).encode('utf-8')
+        self.send_response(200 if status['healthy'] else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Route request logs through the add-on logger."""
+        logger.debug(f"Health endpoint: {format % args}")
+
+
+class SensorWatchdog:
+    """Watchdog for the poll loop and the MQTT network thread.
+
+    Keeps two questions apart: whether the poll loop is still running (its
+    heartbeat advances on every iteration) and whether the last update
+    succeeded. Upstream failures such as a portal outage or a rejected login
+    only mark the add-on unhealthy on the health endpoint, leaving the restart
+    decision to Supervisor. A dead MQTT loop thread is restarted in-process;
+    only a poll loop that has stopped advancing makes the process exit.
+    """
+
+    def __init__(self, sensor, port=HEALTH_PORT):
+        """Initialize the watchdog."""
+        self.sensor = sensor
+        self.port = port
+        # Allow for a failed login retry on top of a full scan interval
+        self.stale_after = sensor.scan_interval * 2 + 120
+        # The loop sleeps up to a scan interval (60 s after a failed login) between heartbeats
+        self.stuck_after = max(sensor.scan_interval, 60) + WATCHDOG_CYCLE_BUDGET
+        self.mqtt_down_since = None
+        self.last_problems = []
+        self.announced_generation = None
+        self.stop_event = threading.Event()
+        self.server = None
+
+    def start(self):
+        """Start the health endpoint and the watchdog thread."""
+        try:
+            handler = type('BoundHealthRequestHandler', (HealthRequestHandler,), {'watchdog': self})
+            self.server = ThreadingHTTPServer(('', self.port), handler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='health-endpoint', daemon=True).start()
+            logger.info(f"Health endpoint listening on port {self.port}")
+        except Exception as e:
+            logger.error(f"Failed to start health endpoint on port {self.port}: {e}")
+
+        threading.Thread(target=self._run, name='watchdog', daemon=True).start()
+
+    def stop(self):
+        """Stop the watchdog and the health endpoint."""
+        self.stop_event.set()
+        if self.server:
+            self.server.shutdown()
+
+    def last_success_age(self):
+        """Seconds since the last successful cycle (or since startup if none yet)."""
+        reference = self.sensor.last_success or self.sensor.started_at
+        return time.monotonic() - reference
+
+    def heartbeat_age(self):
+        """Seconds since the poll loop last advanced."""
+        return time.monotonic() - self.sensor.heartbeat
+
+    def mqtt_loop_alive(self):
+        """Whether the paho network loop thread is running."""
+        # paho-mqtt 1.x does not expose the loop thread publicly
+        thread = getattr(self.sensor.mqtt_client, '_thread', None)
+        return thread is not None and thread.is_alive()
+
+    def problems(self):
+        """Return the reasons the add-on is currently unhealthy."""
+        problems = []
+        if self.heartbeat_age() > self.stuck_after:
+            problems.append('poll loop stuck')
+        if self.last_success_age() > self.stale_after:
+            problems.append('no recent successful update')
+        if self.mqtt_down_since is not None and time.monotonic() - self.mqtt_down_since > self.stale_after:
+            problems.append('mqtt disconnected')
+        return problems
+
+    def status(self):
+        """Return the current health status."""
+        problems = self.problems()
+        return {
+            'healthy': not problems,
+            'problems': problems,
+            'last_success_age': round(self.last_success_age(), 1),
+            'stale_after': self.stale_after,
+            'heartbeat_age': round(self.heartbeat_age(), 1),
+            'stuck_after': self.stuck_after,
+            'mqtt_connected': self.sensor.mqtt_connected,
+            'mqtt_loop_alive': self.mqtt_loop_alive()
+        }
+
+    def _run(self):
+        """Watchdog loop."""
+        while not self.stop_event.wait(WATCHDOG_INTERVAL):
+            try:
+                self.check()
+                self.publish_diagnostics()
+            except Exception as e:
+                logger.error(f"Watchdog error: {e}", exc_info=True)
+
+    def check(self):
+        """Check component health and recover stuck components."""
+        now = time.monotonic()
+
+        # MQTT: restart the loop thread if it died, a live loop reconnects by itself with backoff
+        if not self.sensor.mqtt_setup_done.is_set():
+            logger.debug("Watchdog: MQTT setup still in progress")
+        elif not self.mqtt_loop_alive():
+            logger.warning("Watchdog: MQTT loop thread is not running, restarting it")
+            self.sensor.restart_mqtt()
+        elif not self.sensor.mqtt_connected:
+            if self.mqtt_down_since is None:
+                self.mqtt_down_since = now
+            elif now - self.mqtt_down_since > self.stale_after:
+                logger.warning(f"Watchdog: MQTT disconnected for {now - self.mqtt_down_since:.0f}s, "
+                               "still waiting for the loop to reconnect")
+        else:
+            self.mqtt_down_since = None
+
+        # Poll loop: a loop that stopped advancing cannot be recovered in-process
+        heartbeat_age = self.heartbeat_age()
+        if heartbeat_age > self.stuck_after:
+            logger.error(f"Watchdog: poll loop has not advanced for {heartbeat_age:.0f}s, "
+                         "exiting so Supervisor restarts the add-on")
+            self.publish_diagnostics()
+            os._exit(1)
+
+        # Upstream failures are only reported, the loop keeps retrying
+        problems = self.problems()
+        if problems != self.last_problems:
+            if problems:
+                logger.warning(f"Watchdog: reporting unhealthy ({', '.join(problems)})")
+            else:
+                logger.info("Watchdog: healthy again")
+            self.last_problems = problems
+
+    def publish_diagnostics(self):
+        """Publish the last_success_age diagnostic sensor."""
+        if not self.sensor.mqtt_connected:
+            return
+
+        object_id = "midcity_utilities_last_success_age"
+        config_topic = f"homeassistant/sensor/midcity_utilities/{object_id}/config"
+        state_topic = f"homeassistant/sensor/midcity_utilities/{object_id}/state"
+
+        # Announce the entity once per MQTT connection
+        if self.announced_generation != self.sensor.mqtt_generation:
+            discovery_payload = {
+                "name": "MidCity Last Success Age",
+                "unique_id": object_id,
+                "object_id": object_id,
+                "state_topic": state_topic,
+                "unit_of_measurement": "s",
+                "device_class": "duration",
+                "state_class": "measurement",
+                "entity_category": "diagnostic",
+                "icon": "mdi:heart-pulse",
+                "device": DEVICE_INFO
+            }
+            self.sensor.mqtt_client.publish(config_topic, json.dumps(discovery_payload), retain=True)
+            self.announced_generation = self.sensor.mqtt_generation
+
+        self.sensor.mqtt_client.publish(state_topic, str(round(self.last_success_age())), retain=True)
+
 
 class MidCityUtilitiesSensor:
     """MidCity Utilities Sensor class."""
 
-    def __init__(self, username, password, scan_interval=300, mqtt_user=None, mqtt_password=None):
+    def __init__(self, username, password, scan_interval=300, mqtt_user=None, mqtt_password=None,
+                 startup_profile=False, one_shot=False, dry_run=False):
         """Initialize the sensor."""
         self.username = username
         self.password = password
         self.scan_interval = scan_interval
+
+        # One-shot runs share /data with the running add-on, so they only read the snapshot
+        self.one_shot = one_shot or dry_run
+        self.dry_run = dry_run
+
         self.session = requests.Session()
+        self.forecasters = {}
+
+        # Startup phase timings, printed after the first publish with --startup-profile
+        self.profile = PhaseProfile()
+        self.print_profile = startup_profile
+
+        # Retained messages published this run, and those restored from the last snapshot
+        self.retained = {}
+        self.snapshot_messages = {}
+        self.session_restored = False
+
+        # Device discovery configs published on the current connection, and meters moved off per-entity discovery
+        self.discovery_published = {}
+        self.legacy_migrated = set()
 
+        # Serialised discovery config per meter with the (meter_type, unit) it was built for
+        self.discovery_configs = {}
+        self.snapshot_loaded = threading.Event()
+
+        # Health tracking used by the watchdog
+        self.started_at = time.monotonic()
+        self.heartbeat = self.started_at
+        self.last_success = None
+        self.watchdog = SensorWatchdog(self)
+
+        # Initialize MQTT client, connection is set up in the background by setup_mqtt()
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_connect = self.on_mqtt_connect
+        self.mqtt_client.on_connect_fail = self.on_mqtt_connect_fail
+        self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
+
+        self.mqtt_host = None
+        self.mqtt_port = None
+        self.mqtt_ready = threading.Event()
+        self.mqtt_setup_done = threading.Event()
+        self.mqtt_generation = 0
+
+        self.mqtt_credentials = (mqtt_user, mqtt_password)
+
+    @property
+    def mqtt_connected(self):
+        """Whether the MQTT broker connection is up."""
+        return self.mqtt_ready.is_set()
+
+    def start_mqtt(self):
+        """Start the MQTT setup in the background."""
+        # Supervisor lookup and broker connect run alongside the first portal login
+        threading.Thread(
+            target=self.setup_mqtt,
+            args=self.mqtt_credentials,
+            name='mqtt-setup',
+            daemon=True
+        ).start()
+
+    def setup_mqtt(self, mqtt_user=None, mqtt_password=None):
+        """Look up the broker from Supervisor and start connecting to it."""
         # Get MQTT configuration from Supervisor
-        mqtt_config = self.get_mqtt_config()
+        with self.profile.phase('supervisor lookup'):
+            mqtt_config = self.get_mqtt_config()
         self.mqtt_host = mqtt_config.get('host', 'core-mosquitto')
         self.mqtt_port = mqtt_config.get('port', 1883)
 
@@ -60,9 +649,6 @@ class MidCityUtilitiesSensor:
 
         logger.info(f"MQTT Config - Host: {self.mqtt_host}, Port: {self.mqtt_port}, User: {self.mqtt_user or 'anonymous'}")
 
-        # Initialize MQTT client
-        self.mqtt_client = mqtt.Client()
-
         # Set MQTT credentials if available
         if self.mqtt_user and self.mqtt_password:
             logger.info(f"Using MQTT authentication with user: {self.mqtt_user}")
@@ -70,20 +656,17 @@ class MidCityUtilitiesSensor:
         else:
             logger.info("Using MQTT without authentication (anonymous)")
 
-        # Set MQTT callbacks
-        self.mqtt_client.on_connect = self.on_mqtt_connect
-        self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
-
-        self.mqtt_connected = False
-
-        # Connect to MQTT broker
+        # Connect to MQTT broker, the network loop thread retries until it succeeds
         try:
             logger.info(f"Connecting to MQTT broker at {self.mqtt_host}:{self.mqtt_port}")
-            self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, 60)
+            self.profile.start('mqtt connect')
+            self.mqtt_client.connect_async(self.mqtt_host, self.mqtt_port, 60)
             self.mqtt_client.loop_start()
         except Exception as e:
             logger.error(f"Failed to connect to MQTT broker: {e}")
             logger.error(f"Make sure Mosquitto broker add-on is installed and running")
+        finally:
+            self.mqtt_setup_done.set()
 
     def get_mqtt_config(self):
         """Get MQTT configuration from Supervisor services API."""
@@ -134,7 +717,14 @@ class MidCityUtilitiesSensor:
         """MQTT connection callback."""
         if rc == 0:
             logger.info("Successfully connected to MQTT broker")
-            self.mqtt_connected = True
+            self.profile.stop('mqtt connect')
+            self.discovery_published = {}
+            self.snapshot_loaded.wait()
+            # Republish the snapshot before flagging the connection so fresh data cannot be overwritten
+            if self.snapshot_messages:
+                self.republish_snapshot()
+            self.mqtt_generation += 1
+            self.mqtt_ready.set()
         else:
             error_messages = {
                 1: "Connection refused - incorrect protocol version",
@@ -148,12 +738,175 @@ class MidCityUtilitiesSensor:
             if rc == 5:
                 logger.error("MQTT authentication failed. Check Mosquitto broker configuration.")
                 logger.error("You may need to configure Mosquitto to allow anonymous connections or add user credentials.")
-            self.mqtt_connected = False
+            self.mqtt_ready.clear()
+
+    def on_mqtt_connect_fail(self, client, userdata):
+        """MQTT connection failure callback, the loop thread retries with backoff."""
+        logger.error(f"Failed to connect to MQTT broker at {self.mqtt_host}:{self.mqtt_port}")
+        logger.error(f"Make sure Mosquitto broker add-on is installed and running")
 
     def on_mqtt_disconnect(self, client, userdata, rc):
         """MQTT disconnection callback."""
         logger.warning(f"Disconnected from MQTT broker with code: {rc}")
-        self.mqtt_connected = False
+        self.mqtt_ready.clear()
+
+    def publish(self, topic, payload):
+        """Publish a retained message and remember it for the warm-restart snapshot."""
+        self.retained[topic] = payload
+        return self.mqtt_client.publish(topic, payload, retain=True)
+
+    def save_snapshot(self):
+        """Atomically save the last published messages, forecasts and session cookies."""
+        snapshot = {
+            'format': SNAPSHOT_FORMAT,
+            'saved_at': datetime.now().astimezone().isoformat(),
+            'messages': self.retained,
+            'legacy_migrated': sorted(self.legacy_migrated),
+            'forecasters': {meter: forecaster.to_dict() for meter, forecaster in self.forecasters.items()},
+            'cookies': [
+                {
+                    'name': cookie.name,
+                    'value': cookie.value,
+                    'domain': cookie.domain,
+                    'path': cookie.path,
+                    'expires': cookie.expires,
+                    'secure': cookie.secure
+                }
+                for cookie in self.session.cookies
+            ]
+        }
+
+        tmp_path = f"{SNAPSHOT_PATH}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, SNAPSHOT_PATH)
+            logger.debug(f"Saved snapshot to {SNAPSHOT_PATH}")
+        except Exception as e:
+            logger.warning(f"Could not save snapshot: {e}")
+
+    def load_snapshot(self):
+        """Load the snapshot saved by the previous run, if any.
+
+        Called once MQTT setup is under way so the two overlap; the connect
+        callback waits for it before republishing.
+        """
+        try:
+            self.restore_snapshot()
+        finally:
+            self.snapshot_loaded.set()
+
+    def restore_snapshot(self):
+        """Restore the messages, forecasts and session cookies from the snapshot file."""
+        try:
+            with open(SNAPSHOT_PATH, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            logger.info("No snapshot found, starting cold")
+            return
+        except Exception as e:
+            logger.warning(f"Could not load snapshot: {e}")
+            return
+
+        try:
+            if snapshot.get('format') == SNAPSHOT_FORMAT:
+                # Replaying would mark the running add-on's live state as stale
+                if not self.one_shot:
+                    self.snapshot_messages = snapshot.get('messages', {})
+                self.legacy_migrated = set(snapshot.get('legacy_migrated', []))
+            else:
+                logger.info("Snapshot messages are from an older version, not replaying them")
+
+            for meter_number, data in snapshot.get('forecasters', {}).items():
+                self.forecasters[meter_number] = BalanceForecaster.from_dict(data)
+
+            now = time.time()
+            for cookie in snapshot.get('cookies', []):
+                if cookie.get('expires') and cookie['expires'] < now:
+                    continue
+                self.session.cookies.set(
+                    cookie['name'],
+                    cookie['value'],
+                    domain=cookie.get('domain'),
+                    path=cookie.get('path', '/'),
+                    expires=cookie.get('expires'),
+                    secure=cookie.get('secure', False)
+                )
+                self.session_restored = True
+
+            logger.info(f"Loaded snapshot from {snapshot.get('saved_at')}: "
+                        f"{len(self.snapshot_messages)} message(s), {len(self.forecasters)} forecast(s)")
+        except Exception as e:
+            logger.warning(f"Could not restore snapshot: {e}")
+            self.snapshot_messages = {}
+            self.legacy_migrated = set()
+            self.forecasters = {}
+            self.session_restored = False
+
+    def republish_snapshot(self):
+        """Republish the snapshot messages, marking their state as stale."""
+        logger.info(f"Republishing {len(self.snapshot_messages)} message(s) from snapshot")
+        for topic, payload in self.snapshot_messages.items():
+            if topic.endswith('/config'):
+                # An unchanged config is not republished, so keep it for the next snapshot too
+                self.discovery_published[topic] = payload
+                self.retained[topic] = payload
+            else:
+                try:
+                    state = json.loads(payload)
+                    if isinstance(state, dict) and 'stale' in state:
+                        state['stale'] = True
+                        payload = json.dumps(state, separators=(',', ':'))
+                except ValueError:
+                    pass
+            self.mqtt_client.publish(topic, payload, retain=True)
+        self.snapshot_messages = {}
+
+    def restart_mqtt(self):
+        """Restart the MQTT network loop thread."""
+        try:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.connect_async(self.mqtt_host, self.mqtt_port, 60)
+            self.mqtt_client.loop_start()
+            logger.info("MQTT loop restarted")
+        except Exception as e:
+            logger.error(f"Failed to restart MQTT loop: {e}")
+
+    def portal_request(self, method, url, **kwargs):
+        """Send a portal request, giving up on it after REQUEST_DEADLINE seconds.
+
+        The read timeout alone does not stop a response that keeps trickling in,
+        so the request runs on a worker thread. If it misses the deadline the
+        worker is abandoned along with its session and TimeoutError is raised.
+        """
+        self.heartbeat = time.monotonic()
+        session = self.session
+        result = {}
+
+        def send():
+            try:
+                result['response'] = session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            except Exception as e:
+                result['error'] = e
+
+        worker = threading.Thread(target=send, name='portal-request', daemon=True)
+        worker.start()
+        worker.join(REQUEST_DEADLINE)
+        if worker.is_alive():
+            logger.error(f"{method} {url} still running after {REQUEST_DEADLINE}s, abandoning it")
+            self.reset_session()
+            raise TimeoutError(f"Portal request did not finish within {REQUEST_DEADLINE} seconds")
+        if 'error' in result:
+            raise result['error']
+        return result['response']
+
+    def reset_session(self):
+        """Replace the portal session after a request on it was abandoned."""
+        # The abandoned worker still uses the old session, so it is left to be garbage collected
+        self.session = requests.Session()
+        self.session_restored = False
 
     def login(self):
         """Login to MidCity Utilities website."""
@@ -163,7 +916,8 @@ class MidCityUtilitiesSensor:
                 'password': self.password
             }
 
-            response = self.session.post(LOGIN_URL, data=payload, timeout=30)
+            with self.profile.phase('portal login'):
+                response = self.portal_request('POST', LOGIN_URL, data=payload)
 
             if response.text != '{"ok":true,"success":true}':
                 logger.error("Login failed. Please check your username and password.")
@@ -179,7 +933,8 @@ class MidCityUtilitiesSensor:
     def get_meter_data(self):
         """Retrieve meter data from MidCity Utilities."""
         try:
-            response = self.session.get(METER_URL, timeout=30)
+            with self.profile.phase('meter fetch'):
+                response = self.portal_request('GET', METER_URL)
 
             if response.status_code != 200:
                 logger.error(f"Failed to retrieve meter data. Status code: {response.status_code}")
@@ -194,128 +949,140 @@ class MidCityUtilitiesSensor:
                 logger.warning(f"Could not save HTML for debugging: {e}")
 
             # Parse the HTML content
-            soup = BeautifulSoup(response.text, 'html.parser')
+            with self.profile.phase('parse'):
+                return self.parse_meter_page(response.text, self.profile)
 
-            # Log some info about the page structure
-            logger.info(f"Page title: {soup.title.string if soup.title else 'No title'}")
+        except Exception as e:
+            logger.error(f"Error retrieving meter data: {e}", exc_info=True)
+            return None
 
-            # Use a different strategy: find meter number and balance separately then combine
-            import re
+    @staticmethod
+    def parse_meter_page(html, profile=None):
+        """Extract meter data from the meters page HTML.
 
-            # Find meter number
-            meter_number = None
+        Needs no sensor, login or MQTT, so saved pages can be parsed offline.
+        The bs4 import is timed on ``profile`` when one is given.
+        """
+        with profile.phase('parser import') if profile else nullcontext():
+            from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html, 'html.parser')
 
-            # Strategy 1: Look in "Select Meter" dropdown/text
-            meter_select = soup.find(string=re.compile(r'Select Meter'))
-            if meter_select:
-                match = re.search(r'(\d{8,12})', meter_select)
-                if match:
-                    meter_number = match.group(1)
-                    logger.info(f"Found meter number in 'Select Meter': {meter_number}")
-
-            # Strategy 2: Look in select/option elements
-            if not meter_number:
-                select_elem = soup.find('select', {'name': 'meter_id'})
-                if select_elem:
-                    options = select_elem.find_all('option')
-                    for option in options:
-                        if option.get('value') and re.match(r'\d{8,12}', option.get('value')):
-                            meter_number = option.get('value')
-                            logger.info(f"Found meter number in select option: {meter_number}")
-                            break
-
-            # Strategy 3: Look anywhere in the page for meter number patterns
-            if not meter_number:
-                page_text = soup.get_text()
-                match = re.search(r'(?:Meter|Account)[^\d]*(\d{10,12})', page_text, re.I)
-                if match:
-                    meter_number = match.group(1)
-                    logger.info(f"Found meter number in page text: {meter_number}")
-
-            # Find current balance - it's embedded in JavaScript JSON
-            balance = None
-            unit = None
-
-            # Strategy 1: Look for balance in JavaScript chartObjects
-            scripts = soup.find_all('script')
-            for script in scripts:
-                if script.string and 'chartObjects' in script.string:
-                    script_text = script.string
-                    # Look for the series data with balance
-                    # Pattern: "series":[{"name":"Current balance","0":[145.65],"tooltip":{"valueSuffix":" kWh"}}]
-                    match = re.search(r'"name":"Current balance"[^}]*?"0":\[([0-9.]+)\]', script_text)
-                    if match:
-                        balance = float(match.group(1))
-                        unit = 'kWh'
-                        logger.info(f"Found balance in JavaScript: {balance} {unit}")
-                        break
+        # Log some info about the page structure
+        logger.info(f"Page title: {soup.title.string if soup.title else 'No title'}")
 
-                    # Alternative pattern
-                    match = re.search(r'"series":\[{[^}]*?"0":\[([0-9.]+)\][^}]*?"valueSuffix":" kWh"', script_text)
-                    if match:
-                        balance = float(match.group(1))
-                        unit = 'kWh'
-                        logger.info(f"Found balance in JavaScript (alt): {balance} {unit}")
-                        break
+        # Use a different strategy: find meter number and balance separately then combine
+        import re
 
-            # Strategy 2: Look for balance in HTML text (fallback)
-            if not balance:
-                balance_text_elem = soup.find(string=re.compile(r'Current meter balance[:\s]+[\d.]+\s*kWh', re.I))
-                if balance_text_elem:
-                    balance_text = balance_text_elem.strip()
-                    logger.debug(f"Found balance text in HTML: {balance_text}")
-                    match = re.search(r'([\d,]+\.?\d*)\s*kWh', balance_text, re.I)
-                    if match:
-                        balance_str = match.group(1).replace(',', '')
-                        balance = float(balance_str)
-                        unit = 'kWh'
-                        logger.info(f"Found balance in HTML: {balance} {unit}")
+        # Find meter number
+        meter_number = None
 
-            # Find predicted zero balance date
-            predicted_zero_date = None
+        # Strategy 1: Look in "Select Meter" dropdown/text
+        meter_select = soup.find(string=re.compile(r'Select Meter'))
+        if meter_select:
+            match = re.search(r'(\d{8,12})', meter_select)
+            if match:
+                meter_number = match.group(1)
+                logger.info(f"Found meter number in 'Select Meter': {meter_number}")
+
+        # Strategy 2: Look in select/option elements
+        if not meter_number:
+            select_elem = soup.find('select', {'name': 'meter_id'})
+            if select_elem:
+                options = select_elem.find_all('option')
+                for option in options:
+                    if option.get('value') and re.match(r'\d{8,12}', option.get('value')):
+                        meter_number = option.get('value')
+                        logger.info(f"Found meter number in select option: {meter_number}")
+                        break
 
-            # Strategy 1: Search in all text for the predicted date
+        # Strategy 3: Look anywhere in the page for meter number patterns
+        if not meter_number:
             page_text = soup.get_text()
-            # Look for "Predicted 0 balance date: 2025-12-13" pattern
-            date_match = re.search(r'Predicted\s+0\s+balance\s+date[:\s]+(\d{4}-\d{2}-\d{2})', page_text, re.I)
+            match = re.search(r'(?:Meter|Account)[^\d]*(\d{10,12})', page_text, re.I)
+            if match:
+                meter_number = match.group(1)
+                logger.info(f"Found meter number in page text: {meter_number}")
+
+        # Find current balance - it's embedded in JavaScript JSON
+        balance = None
+        unit = None
+
+        # Strategy 1: Look for balance in JavaScript chartObjects
+        scripts = soup.find_all('script')
+        for script in scripts:
+            if script.string and 'chartObjects' in script.string:
+                script_text = script.string
+                # Look for the series data with balance
+                # Pattern: "series":[{"name":"Current balance","0":[145.65],"tooltip":{"valueSuffix":" kWh"}}]
+                match = re.search(r'"name":"Current balance"[^}]*?"0":\[([0-9.]+)\]', script_text)
+                if match:
+                    balance = float(match.group(1))
+                    unit = 'kWh'
+                    logger.info(f"Found balance in JavaScript: {balance} {unit}")
+                    break
+
+                # Alternative pattern
+                match = re.search(r'"series":\[{[^}]*?"0":\[([0-9.]+)\][^}]*?"valueSuffix":" kWh"', script_text)
+                if match:
+                    balance = float(match.group(1))
+                    unit = 'kWh'
+                    logger.info(f"Found balance in JavaScript (alt): {balance} {unit}")
+                    break
+
+        # Strategy 2: Look for balance in HTML text (fallback)
+        if not balance:
+            balance_text_elem = soup.find(string=re.compile(r'Current meter balance[:\s]+[\d.]+\s*kWh', re.I))
+            if balance_text_elem:
+                balance_text = balance_text_elem.strip()
+                logger.debug(f"Found balance text in HTML: {balance_text}")
+                match = re.search(r'([\d,]+\.?\d*)\s*kWh', balance_text, re.I)
+                if match:
+                    balance_str = match.group(1).replace(',', '')
+                    balance = float(balance_str)
+                    unit = 'kWh'
+                    logger.info(f"Found balance in HTML: {balance} {unit}")
+
+        # Find predicted zero balance date
+        predicted_zero_date = None
+
+        # Strategy 1: Search in all text for the predicted date
+        page_text = soup.get_text()
+        # Look for "Predicted 0 balance date: 2025-12-13" pattern
+        date_match = re.search(r'Predicted\s+0\s+balance\s+date[:\s]+(\d{4}-\d{2}-\d{2})', page_text, re.I)
+        if date_match:
+            predicted_zero_date = date_match.group(1)
+            logger.info(f"Found predicted zero date: {predicted_zero_date}")
+        else:
+            # Try alternative format with slashes
+            date_match = re.search(r'Predicted\s+0\s+balance\s+date[:\s]+(\d{1,2}[/-]\d{1,2}[/-]\d{4})', page_text, re.I)
             if date_match:
                 predicted_zero_date = date_match.group(1)
                 logger.info(f"Found predicted zero date: {predicted_zero_date}")
             else:
-                # Try alternative format with slashes
-                date_match = re.search(r'Predicted\s+0\s+balance\s+date[:\s]+(\d{1,2}[/-]\d{1,2}[/-]\d{4})', page_text, re.I)
-                if date_match:
-                    predicted_zero_date = date_match.group(1)
-                    logger.info(f"Found predicted zero date: {predicted_zero_date}")
-                else:
-                    logger.debug("Predicted zero date not found in page text")
-
-            # Create meter data if we found both
-            meters = []
-            if meter_number and balance is not None:
-                meter_data = {
-                    'meter_number': meter_number,
-                    'balance': balance,
-                    'meter_type': 'electricity',  # kWh indicates electricity
-                    'unit': unit,
-                    'last_updated': datetime.now().isoformat()
-                }
-
-                # Add predicted zero date if found
-                if predicted_zero_date:
-                    meter_data['predicted_zero_date'] = predicted_zero_date
+                logger.debug("Predicted zero date not found in page text")
+
+        # Create meter data if we found both
+        meters = []
+        if meter_number and balance is not None:
+            meter_data = {
+                'meter_number': meter_number,
+                'balance': balance,
+                'meter_type': 'electricity',  # kWh indicates electricity
+                'unit': unit,
+                'last_updated': datetime.now().isoformat()
+            }
 
-                meters.append(meter_data)
-                logger.info(f"Successfully combined meter data: {meter_data}")
-            else:
-                logger.warning(f"Could not combine meter data - meter_number: {meter_number}, balance: {balance}")
+            # Add predicted zero date if found
+            if predicted_zero_date:
+                meter_data['predicted_zero_date'] = predicted_zero_date
 
-            logger.info(f"Retrieved data for {len(meters)} meter(s)")
-            return meters if meters else None
+            meters.append(meter_data)
+            logger.info(f"Successfully combined meter data: {meter_data}")
+        else:
+            logger.warning(f"Could not combine meter data - meter_number: {meter_number}, balance: {balance}")
 
-        except Exception as e:
-            logger.error(f"Error retrieving meter data: {e}", exc_info=True)
-            return None
+        logger.info(f"Retrieved data for {len(meters)} meter(s)")
+        return meters if meters else None
 
     def get_meter_data_old(self):
         """Old method - kept for reference."""
@@ -327,6 +1094,7 @@ class MidCityUtilitiesSensor:
                 return None
 
             # Parse the HTML content
+            from bs4 import BeautifulSoup
             soup = BeautifulSoup(response.text, 'html.parser')
 
             meters = []
@@ -597,161 +1365,486 @@ class MidCityUtilitiesSensor:
 
         return meter_data if meter_data.get('meter_number') and meter_data.get('balance') is not None else None
 
+    def update_forecasts(self, meter_data):
+        """Feed new readings into the per-meter forecasters and attach the results."""
+        for meter in meter_data:
+            meter_number = meter.get('meter_number', 'unknown')
+            forecaster = self.forecasters.get(meter_number)
+            if forecaster is None:
+                forecaster = BalanceForecaster()
+                self.forecasters[meter_number] = forecaster
+
+            try:
+                forecaster.add_reading(meter['balance'])
+                forecast = forecaster.forecast()
+            except Exception as e:
+                logger.error(f"Error updating forecast for meter {meter_number}: {e}", exc_info=True)
+                continue
+
+            if forecast:
+                meter['forecast'] = forecast
+                logger.info(f"Forecast for meter {meter_number}: {forecast['hours_remaining']}h remaining "
+                            f"({forecast['hours_remaining_low']}-{forecast['hours_remaining_high']}h), "
+                            f"burn rate {forecast['burn_rate']} {meter.get('unit', 'kWh')}/h")
+            else:
+                logger.debug(f"Not enough readings yet to forecast meter {meter_number}")
+
+    def build_discovery_payload(self, meter):
+        """Build the device discovery payload describing every entity of a meter."""
+        meter_number = meter.get('meter_number', 'unknown')
+        meter_type = meter.get('meter_type', 'unknown')
+        unit = meter.get('unit', 'kWh')
+        object_id = f"midcity_{meter_type}_{meter_number}"
+
+        # Determine device class and icon based on meter type
+        if meter_type == 'electricity':
+            device_class = 'energy'
+            icon = 'mdi:lightning-bolt'
+            unit_of_measurement = unit
+        elif meter_type == 'water':
+            device_class = 'water'
+            icon = 'mdi:water'
+            unit_of_measurement = unit
+        else:
+            device_class = 'monetary'
+            icon = 'mdi:cash'
+            unit_of_measurement = 'ZAR' if unit == 'ZAR' else unit
+
+        # Every entity reads its value and attributes from the shared state document
+        components = {
+            'balance': {
+                "name": None,
+                "unit_of_measurement": unit_of_measurement,
+                "device_class": device_class,
+                "state_class": "measurement",
+                "icon": icon
+            },
+            'hours_remaining': {
+                "name": "Hours Remaining",
+                "unit_of_measurement": "h",
+                "device_class": "duration",
+                "state_class": "measurement",
+                "icon": "mdi:timer-sand"
+            },
+            'predicted_depletion': {
+                "name": "Predicted Depletion",
+                "device_class": "timestamp",
+                "icon": "mdi:calendar-alert"
+            },
+            'burn_rate': {
+                "name": "Burn Rate",
+                "unit_of_measurement": f"{unit}/h",
+                "state_class": "measurement",
+                "icon": "mdi:fire"
+            }
+        }
+        for key, component in components.items():
+            # Keep the unique_ids of the per-entity discovery used before 1.7.0
+            component_id = object_id if key == 'balance' else f"{object_id}_{key}"
+            component.update({
+                "platform": "sensor",
+                "unique_id": component_id,
+                "object_id": component_id,
+                "value_template": f"{{{{ value_json.{key} }}}}",
+                "json_attributes_template":
+                    f"{{{{ dict(value_json.attributes.{key}, stale=value_json.stale) | tojson }}}}"
+            })
+
+        return {
+            "device": {
+                "identifiers": [f"midcity_{meter_number}"],
+                "name": f"MidCity {meter_type.title()}",
+                "model": "MidCity Utilities Monitor",
+                "manufacturer": "MidCity Utilities",
+                "serial_number": meter_number,
+                "sw_version": SW_VERSION,
+                "via_device": DEVICE_INFO["identifiers"][0]
+            },
+            "origin": {
+                "name": "MidCity Utilities Sensor",
+                "sw_version": SW_VERSION,
+                "support_url": "https://github.com/Hassio-Addons/MidCity-Utilities"
+            },
+            "components": components,
+            # Shared by all components
+            "state_topic": self.state_topic(meter_number),
+            "json_attributes_topic": self.state_topic(meter_number)
+        }
+
+    def discovery_config(self, meter):
+        """Return the serialised discovery config, rebuilding it only when the meter type or unit changes."""
+        meter_number = meter.get('meter_number', 'unknown')
+        key = (meter.get('meter_type', 'unknown'), meter.get('unit', 'kWh'))
+        cached = self.discovery_configs.get(meter_number)
+        if cached is None or cached[0] != key:
+            config = json.dumps(self.build_discovery_payload(meter), separators=(',', ':'))
+            cached = self.discovery_configs[meter_number] = (key, config)
+        return cached[1]
+
+    def build_state_payload(self, meter):
+        """Build the state document read by every entity of a meter."""
+        forecast = meter.get('forecast') or {}
+
+        balance_attributes = {
+            'meter_number': meter.get('meter_number', 'unknown'),
+            'meter_type': meter.get('meter_type', 'unknown'),
+            'last_updated': meter.get('last_updated'),
+            'attribution': 'Data from MidCity Utilities'
+        }
+
+        # Add predicted zero date if available
+        if meter.get('predicted_zero_date'):
+            balance_attributes['predicted_zero_date'] = meter['predicted_zero_date']
+
+        forecast_attributes = {
+            'meter_number': meter.get('meter_number', 'unknown'),
+            'readings': forecast.get('readings'),
+            'window_hours': forecast.get('window_hours'),
+            'attribution': 'Forecast by MidCity Utilities Sensor'
+        }
+
+        return {
+            'balance': meter.get('balance', 0),
+            'hours_remaining': forecast.get('hours_remaining'),
+            'predicted_depletion': forecast.get('predicted_depletion'),
+            'burn_rate': forecast.get('burn_rate'),
+            'stale': False,
+            'attributes': {
+                'balance': balance_attributes,
+                'hours_remaining': dict(
+                    forecast_attributes,
+                    hours_remaining_low=forecast.get('hours_remaining_low'),
+                    hours_remaining_high=forecast.get('hours_remaining_high')
+                ),
+                'predicted_depletion': dict(
+                    forecast_attributes,
+                    depletion_earliest=forecast.get('depletion_earliest'),
+                    depletion_latest=forecast.get('depletion_latest')
+                ),
+                'burn_rate': dict(forecast_attributes, burn_rate_error=forecast.get('burn_rate_error'))
+            }
+        }
+
+    @staticmethod
+    def state_topic(meter_number):
+        """State topic shared by all entities of a meter."""
+        return f"midcity_utilities/{meter_number}/state"
+
+    def migrate_legacy_discovery(self, meter):
+        """Hand the per-entity discovery topics used before 1.7.0 over to device discovery."""
+        meter_number = meter.get('meter_number', 'unknown')
+        object_id = f"midcity_{meter.get('meter_type', 'unknown')}_{meter_number}"
+        legacy_ids = [object_id] + [f"{object_id}_{key}" for key in ('hours_remaining', 'predicted_depletion', 'burn_rate')]
+
+        # Home Assistant keeps the entities if migrate_discovery arrives before the new config
+        for legacy_id in legacy_ids:
+            self.mqtt_client.publish(
+                f"homeassistant/sensor/midcity_utilities/{legacy_id}/config",
+                json.dumps({"migrate_discovery": True}),
+                retain=True
+            )
+        return [
+            f"homeassistant/sensor/midcity_utilities/{legacy_id}/{suffix}"
+            for legacy_id in legacy_ids
+            for suffix in ('config', 'state', 'attributes')
+        ]
+
     def publish_mqtt_discovery(self, meter_data):
-        """Publish MQTT Discovery messages for Home Assistant."""
+        """Publish MQTT Discovery messages for Home Assistant. Returns True if published."""
         try:
             if not self.mqtt_connected:
                 logger.error("Cannot publish sensors - MQTT not connected")
                 logger.info("Sensor data that would be created:")
                 for meter in meter_data:
                     logger.info(f"  - Meter {meter.get('meter_number')}: {meter.get('balance')} {meter.get('unit')}")
-                return
+                return False
 
             for meter in meter_data:
                 meter_number = meter.get('meter_number', 'unknown')
-                balance = meter.get('balance', 0)
-                meter_type = meter.get('meter_type', 'unknown')
-                unit = meter.get('unit', 'kWh')
-                predicted_zero_date = meter.get('predicted_zero_date', None)
-
-                # Create unique_id for this sensor
-                unique_id = f"midcity_{meter_type}_{meter_number}"
-                object_id = f"midcity_{meter_type}_{meter_number}"
-
-                # Determine device class and icon based on meter type
-                if meter_type == 'electricity':
-                    device_class = 'energy'
-                    icon = 'mdi:lightning-bolt'
-                    unit_of_measurement = unit
-                elif meter_type == 'water':
-                    device_class = 'water'
-                    icon = 'mdi:water'
-                    unit_of_measurement = unit
-                else:
-                    device_class = 'monetary'
-                    icon = 'mdi:cash'
-                    unit_of_measurement = 'ZAR' if unit == 'ZAR' else unit
-
-                # Friendly name for the entity
-                friendly_name = f'MidCity {meter_type.title()}'
-
-                # MQTT topics
-                config_topic = f"homeassistant/sensor/midcity_utilities/{object_id}/config"
-                state_topic = f"homeassistant/sensor/midcity_utilities/{object_id}/state"
-                attributes_topic = f"homeassistant/sensor/midcity_utilities/{object_id}/attributes"
-
-                # Discovery payload
-                discovery_payload = {
-                    "name": friendly_name,
-                    "unique_id": unique_id,
-                    "object_id": object_id,
-                    "state_topic": state_topic,
-                    "json_attributes_topic": attributes_topic,
-                    "unit_of_measurement": unit_of_measurement,
-                    "device_class": device_class,
-                    "icon": icon,
-                    "state_class": "measurement",
-                    "device": {
-                        "identifiers": ["midcity_utilities_sensor"],
-                        "name": "MidCity Utilities Sensor",
-                        "model": "MidCity Utilities Monitor",
-                        "manufacturer": "MidCity Utilities",
-                        "sw_version": "1.2.4"
-                    }
-                }
+                config_topic = f"homeassistant/device/midcity_{meter_number}/config"
 
-                # Publish discovery message
-                logger.info(f"Publishing MQTT discovery for {unique_id}")
-                self.mqtt_client.publish(
-                    config_topic,
-                    json.dumps(discovery_payload),
-                    retain=True
-                )
+                # The config only changes with the meter type or unit, publish it once per connection
+                config = self.discovery_config(meter)
+                if self.discovery_published.get(config_topic) != config:
+                    legacy_topics = []
+                    if meter_number not in self.legacy_migrated:
+                        legacy_topics = self.migrate_legacy_discovery(meter)
 
-                # Publish state
-                logger.debug(f"Publishing state: {balance}")
-                self.mqtt_client.publish(
-                    state_topic,
-                    str(balance),
-                    retain=True
-                )
+                    logger.info(f"Publishing MQTT device discovery for meter {meter_number}")
+                    self.publish(config_topic, config)
+                    self.discovery_published[config_topic] = config
 
-                # Publish attributes
-                attributes = {
-                    'meter_number': meter_number,
-                    'meter_type': meter_type,
-                    'last_updated': meter.get('last_updated'),
-                    'attribution': 'Data from MidCity Utilities'
-                }
+                    # Clear the old retained topics once the device config has taken over
+                    for topic in legacy_topics:
+                        self.mqtt_client.publish(topic, '', retain=True)
+                    self.legacy_migrated.add(meter_number)
 
-                # Add predicted zero date if available
-                if predicted_zero_date:
-                    attributes['predicted_zero_date'] = predicted_zero_date
-                    logger.debug(f"Adding predicted zero date to attributes: {predicted_zero_date}")
+                # Publish state
+                state = json.dumps(self.build_state_payload(meter), separators=(',', ':'))
+                logger.debug(f"Publishing state: {state}")
+                self.publish(self.state_topic(meter_number), state)
 
-                logger.debug(f"Publishing attributes: {attributes}")
-                self.mqtt_client.publish(
-                    attributes_topic,
-                    json.dumps(attributes),
-                    retain=True
-                )
+                logger.info(f"Successfully published meter {meter_number} = {meter.get('balance')} {meter.get('unit')}")
 
-                logger.info(f"Successfully published sensor: sensor.{object_id} = {balance} {unit_of_measurement}")
+            return True
 
         except Exception as e:
             logger.error(f"Error publishing MQTT discovery: {e}", exc_info=True)
+            return False
+
+    def preview_mqtt_discovery(self, meter_data):
+        """Build the discovery and state payloads for a dry run without publishing them."""
+        for meter in meter_data:
+            meter_number = meter.get('meter_number', 'unknown')
+            config = self.discovery_config(meter)
+            state = json.dumps(self.build_state_payload(meter), separators=(',', ':'))
+            logger.info(f"Dry run, not publishing meter {meter_number} = {meter.get('balance')} {meter.get('unit')}")
+            logger.debug(f"Discovery config: {config}")
+            logger.debug(f"State: {state}")
+
+    def update(self):
+        """Run one update cycle.
+
+        Returns True if fresh data was published (or built, in a dry run), False
+        if it was not and None if the login failed.
+        """
+        logger.info("Fetching meter data...")
+
+        # Try the restored session first, it saves a login if the cookies are still valid
+        meter_data = None
+        if self.session_restored:
+            self.session_restored = False
+            meter_data = self.get_meter_data()
+            if not meter_data:
+                logger.info("Restored session expired, logging in")
+
+        if not meter_data:
+            # Login
+            if not self.login():
+                return None
+
+            # Get meter data
+            meter_data = self.get_meter_data()
+
+        if not meter_data:
+            logger.warning("No meter data retrieved")
+            return False
+
+        # Update the balance forecasts
+        with self.profile.phase('forecast'):
+            self.update_forecasts(meter_data)
+
+        if self.dry_run:
+            with self.profile.phase('publish'):
+                self.preview_mqtt_discovery(meter_data)
+        else:
+            # The broker connects in the background, wait for it only when there is data to publish
+            if not self.mqtt_connected:
+                logger.info("Waiting for MQTT connection...")
+                with self.profile.phase('mqtt wait'):
+                    if self.mqtt_ready.wait(MQTT_CONNECT_TIMEOUT):
+                        logger.info("✓ MQTT connection established")
+                    else:
+                        logger.warning(f"MQTT connection not established after {MQTT_CONNECT_TIMEOUT} seconds")
+
+            # Publish MQTT Discovery messages
+            with self.profile.phase('publish'):
+                published = self.publish_mqtt_discovery(meter_data)
+            if not published:
+                return False
+
+        self.last_success = time.monotonic()
+        if not self.one_shot:
+            with self.profile.phase('snapshot save'):
+                self.save_snapshot()
+        if not self.profile.finished:
+            report = self.profile.finish()
+            if self.print_profile:
+                print(report, flush=True)
+        return True
 
     def run(self):
         """Main run loop."""
         logger.info("Starting MidCity Utilities sensor...")
         logger.info(f"Scan interval: {self.scan_interval} seconds")
 
-        # Wait for MQTT connection to be established
-        logger.info("Waiting for MQTT connection...")
-        max_wait = 30  # Wait up to 30 seconds
-        wait_time = 0
-        while not self.mqtt_connected and wait_time < max_wait:
-            time.sleep(1)
-            wait_time += 1
-
-        if self.mqtt_connected:
-            logger.info("✓ MQTT connection established, starting sensor loop")
-        else:
-            logger.warning(f"MQTT connection not established after {max_wait} seconds")
-            logger.warning("Will continue anyway, but sensors may not be published")
+        self.start_mqtt()
+        self.watchdog.start()
+        with self.profile.phase('snapshot load'):
+            self.load_snapshot()
 
         while True:
+            self.heartbeat = time.monotonic()
             try:
-                logger.info("Fetching meter data...")
-
-                # Login
-                if not self.login():
+                if self.update() is None:
                     logger.error("Failed to login. Retrying in 60 seconds...")
                     time.sleep(60)
                     continue
 
-                # Get meter data
-                meter_data = self.get_meter_data()
-
-                if meter_data:
-                    # Publish MQTT Discovery messages
-                    self.publish_mqtt_discovery(meter_data)
-                else:
-                    logger.warning("No meter data retrieved")
-
                 logger.info(f"Waiting {self.scan_interval} seconds until next update...")
                 time.sleep(self.scan_interval)
 
             except KeyboardInterrupt:
                 logger.info("Shutting down...")
+                self.shutdown()
                 break
             except Exception as e:
                 logger.error(f"Unexpected error: {e}")
                 time.sleep(60)
 
+    def run_once(self, iterations=1):
+        """Run a fixed number of update cycles back to back.
+
+        Returns whether every cycle published fresh data, and the phase
+        durations of each cycle.
+        """
+        if not self.dry_run:
+            self.start_mqtt()
+        with self.profile.phase('snapshot load'):
+            self.load_snapshot()
+        succeeded = True
+        timings = []
+        try:
+            for iteration in range(iterations):
+                if iteration:
+                    self.profile = PhaseProfile()
+                started = time.perf_counter()
+                result = self.update()
+                if result is None:
+                    logger.error("Failed to login")
+                succeeded = succeeded and bool(result)
+
+                durations = self.profile.durations()
+                durations['cycle'] = time.perf_counter() - started
+                timings.append(durations)
+        finally:
+            self.shutdown()
+        return succeeded, timings
+
+    def shutdown(self):
+        """Stop the watchdog and flush pending MQTT messages."""
+        self.watchdog.stop()
+        if self.mqtt_connected:
+            # The DISCONNECT packet is queued behind any pending publishes
+            self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="MidCity Utilities sensor for Home Assistant")
+    parser.add_argument(
+        '--startup-profile',
+        action='store_true',
+        help="print an import-time and startup phase breakdown after the first publish"
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help="run a single update cycle and exit"
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help="build the MQTT payloads without connecting to the broker or publishing (implies --once)"
+    )
+    parser.add_argument(
+        '--parse-file',
+        metavar='PATH',
+        help="run the extractors on a saved meters page and print the result, no login or MQTT needed"
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=f"run the cycle under cProfile and write the stats to {PROFILE_DIR} (implies --once)"
+    )
+    parser.add_argument(
+        '--profile-dir',
+        default=PROFILE_DIR,
+        metavar='DIR',
+        help=f"directory for --profile stats (default: {PROFILE_DIR})"
+    )
+    parser.add_argument(
+        '--iterations',
+        type=int,
+        metavar='N',
+        help="run N cycles back to back and report min, median and p99 timings per phase (implies --once)"
+    )
+    args = parser.parse_args()
+    if args.iterations is not None and args.iterations < 1:
+        parser.error("--iterations must be at least 1")
+    return args
+
+
+def run_profiled(func, profile_dir):
+    """Run func under cProfile, write the stats to profile_dir and print the top entries."""
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        path = os.path.join(profile_dir, f"midcity_profile_{datetime.now():%Y%m%d_%H%M%S}.prof")
+        try:
+            profiler.dump_stats(path)
+            print(f"Profile stats written to {path}")
+        except OSError as e:
+            logger.error(f"Could not write profile stats to {path}: {e}")
+        # Background threads (MQTT, watchdog) are not included
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(25)
+
+
+def parse_saved_page(html, iterations=1):
+    """Run the extractors on saved meters page HTML.
+
+    Returns the meter data and the parse durations of each iteration.
+    """
+    meter_data = None
+    timings = []
+    for _ in range(iterations):
+        profile = PhaseProfile()
+        with profile.phase('parse'):
+            meter_data = MidCityUtilitiesSensor.parse_meter_page(html, profile)
+        timings.append(profile.durations())
+    return meter_data, timings
+
+
+def report_timings(timings):
+    """Print min, median and p99 durations per phase over all iterations."""
+    import numpy as np
+    phases = {}
+    for durations in timings:
+        for name, duration in durations.items():
+            phases.setdefault(name, []).append(duration * 1000)
+
+    print(f"Phase timings over {len(timings)} iteration(s)")
+    print(f"  {'phase':<20}{'n':>5}{'min':>12}{'median':>12}{'p99':>12}")
+    for name, values in sorted(phases.items(), key=lambda phase: -np.median(phase[1])):
+        values = np.array(values)
+        print(f"  {name:<20}{len(values):>5}{values.min():>10.1f}ms"
+              f"{np.median(values):>10.1f}ms{np.percentile(values, 99):>10.1f}ms")
+
 
 def main():
     """Main function."""
+    args = parse_args()
+    iterations = args.iterations or 1
+
+    # Saved pages can be parsed without any configuration
+    if args.parse_file:
+        try:
+            with open(args.parse_file, 'r', encoding='utf-8') as f:
+                html = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f"Failed to read {args.parse_file}: {e}")
+            sys.exit(1)
+        work = functools.partial(parse_saved_page, html, iterations)
+        meter_data, timings = run_profiled(work, args.profile_dir) if args.profile else work()
+        print(json.dumps(meter_data, indent=2))
+        if args.iterations:
+            report_timings(timings)
+        sys.exit(0 if meter_data else 1)
+
     # Read configuration from options.json
     try:
         with open('/data/options.json', 'r') as f:
@@ -781,8 +1874,19 @@ def main():
         password,
         scan_interval,
         mqtt_user if mqtt_user else None,
-        mqtt_password if mqtt_password else None
+        mqtt_password if mqtt_password else None,
+        startup_profile=args.startup_profile,
+        one_shot=bool(args.once or args.profile or args.iterations),
+        dry_run=args.dry_run
     )
+
+    if sensor.one_shot:
+        work = functools.partial(sensor.run_once, iterations)
+        succeeded, timings = run_profiled(work, args.profile_dir) if args.profile else work()
+        if args.iterations:
+            report_timings(timings)
+        sys.exit(0 if succeeded else 1)
+
     sensor.run()
 
 